@@ -31,15 +31,18 @@ import threading
 import time
 import weakref
 
+from collections import deque
 from pushy.protocol.message import Message, MessageType, message_types
 from pushy.protocol.proxy import Proxy, ProxyType, proxy_types
 import pushy.util
 
 # This collection should contain only immutable types. Builtin, mutable types
-# such as list, set and dict need to be handled specially.
+# such as list, set and dict need to be handled specially. Membership is
+# tested against type(obj), so only concrete types are listed (basestring is
+# never the type of an object).
 marshallable_types = [
-    unicode, slice, frozenset, float, basestring, long, str, int, complex,
-    bool, type(None)
+    unicode, slice, frozenset, float, long, str, int, complex, bool,
+    type(None)
 ]
 
 # The 'buffer' type doesn't exist in Jython.
@@ -52,7 +55,16 @@ except NameError: pass
 response_types = (
     MessageType.response, MessageType.exception
 )
-marshallable_types = tuple(marshallable_types)
+marshallable_types = frozenset(marshallable_types)
+
+
+# Logging calls are guarded by this flag, so that they (and their arguments)
+# cost nothing on the message paths when debug logging is disabled. It is
+# evaluated once, at import time: to get debug output from this module, enable
+# the logger in pushy.util._logging before pushy.protocol is imported. Enabling
+# pushy.util.logger at runtime will not affect it.
+_DEBUG = not pushy.util.logger.disabled and \
+         pushy.util.logger.isEnabledFor(logging.DEBUG)
 
 
 # Marshalling constants.
@@ -61,7 +73,8 @@ MARSHAL_ORIGIN = 1
 MARSHAL_PROXY  = 2
 
 
-class LoggingFile:
+class LoggingFile(object):
+    __slots__ = ("stream", "log")
     def __init__(self, stream, log):
         self.stream = stream
         self.log = log
@@ -91,7 +104,11 @@ class MessageStream:
         finally:
             self.__lock.release()
     def send_message(self, m):
-        bytes_ = m.pack()
+        self.__write(m.pack())
+    def send_messages(self, messages):
+        "Send a sequence of messages in a single write."
+        self.__write("".join([m.pack() for m in messages]))
+    def __write(self, bytes_):
         self.__lock.acquire()
         try:
             self.__file.write(bytes_)
@@ -106,11 +123,19 @@ class MessageStream:
             self.__lock.release()
 
 
-class ResponseHandler:
-    def __init__(self, condition):
+class ResponseHandler(object):
+    __slots__ = ("condition", "message", "thread")
+    def __init__(self, condition, thread_id):
         self.condition = condition
         self.message   = None
-        self.thread    = thread.get_ident()
+        self.thread    = thread_id
+
+
+class ThreadState(threading.local):
+    "Per-thread connection state. Class attributes provide the defaults."
+    request_count    = 0
+    peer_thread      = 0
+    response_handler = None
 
 
 connection_count_lock = threading.Lock()
@@ -133,6 +158,9 @@ class BaseConnection(object):
         self.__ostream = MessageStream(ostream)
         self.__initiator = initiator
         self.__marshal_lock = threading.Lock()
+        # This must be reentrant: "delete" is a weakref callback, so it may be
+        # invoked by the garbage collector in a thread that is already
+        # holding the lock in __get_delete_message.
         self.__delete_lock = threading.RLock()
         self.__connid = get_connection_id()
         self.__last_delete = time.time()
@@ -146,7 +174,7 @@ class BaseConnection(object):
         }
 
         # Attributes required to track responses.
-        self.__thread_local = threading.local()
+        self.__thread_local = ThreadState()
         self.__response_handlers = {}
 
         # Attributes required to track number of threads processing requests.
@@ -161,8 +189,12 @@ class BaseConnection(object):
         self.__processing = 0  # How many requests are being processed.
         self.__waiting = 0  # How many responses are pending.
         self.__responses = 0
-        self.__requests = []
+        self.__requests = deque() # Enqueued at the left, taken from the right.
         self.__processing_condition = threading.Condition(threading.Lock())
+        # How many threads are waiting on the processing condition. This is
+        # only modified with the condition's lock held, so notifications can
+        # safely be skipped when it is zero.
+        self.__condition_waiters = 0
 
         # Uncomment the following for debugging.
         if False:
@@ -181,7 +213,9 @@ class BaseConnection(object):
         self.__proxy_ids = {}
         # (Client) Contains a mapping of id(obj) -> version
         self.__pending_deletes = {}
-        # (Server) Contains mapping of id(obj) -> (obj, proxy-info)
+        # (Server) Contains mapping of id(obj) -> (obj, description, version).
+        # The description is computed once, when the object is first proxied,
+        # and reused each time the object is marshalled thereafter.
         self.__proxied_objects = {}
 
 
@@ -217,7 +251,7 @@ Proxied Object Count: %r
     # Property for determining the number of requests the current thread is
     # processing.
     def __get_thread_request_count(self):
-        return getattr(self.__thread_local, "request_count", 0)
+        return self.__thread_local.request_count
     def __set_thread_request_count(self, value):
         self.__thread_local.request_count = value
     __thread_request_count = \
@@ -226,7 +260,7 @@ Proxied Object Count: %r
 
     # Property for getting the current thread's peer thread.
     def __get_peer_thread(self):
-        return getattr(self.__thread_local, "peer_thread", 0)
+        return self.__thread_local.peer_thread
     def __set_peer_thread(self, value):
         self.__thread_local.peer_thread = value
     __peer_thread = property(__get_peer_thread, __set_peer_thread)
@@ -244,18 +278,22 @@ Proxied Object Count: %r
             self.__processing_condition.acquire()
             try:
                 # Wake up request/response handlers.
-                self.__processing_condition.notifyAll()
+                if self.__condition_waiters:
+                    self.__processing_condition.notifyAll()
             finally:
                 self.__processing_condition.release()
 
             self.__ostream.close()
-            pushy.util.logger.debug("Closed ostream")
+            if _DEBUG:
+                pushy.util.logger.debug("Closed ostream")
             self.__istream.close()
-            pushy.util.logger.debug("Closed istream")
+            if _DEBUG:
+                pushy.util.logger.debug("Closed istream")
         except:
             import traceback
             traceback.print_exc()
-            pushy.util.logger.debug(traceback.format_exc())
+            if _DEBUG:
+                pushy.util.logger.debug(traceback.format_exc())
 
 
     def serve_forever(self):
@@ -269,7 +307,8 @@ Proxied Object Count: %r
                 except IOError:
                     return
         finally:
-            pushy.util.logger.debug("Leaving serve_forever")
+            if _DEBUG:
+                pushy.util.logger.debug("Leaving serve_forever")
 
 
     def send_request(self, message_type, args):
@@ -290,19 +329,28 @@ Proxied Object Count: %r
 
         # If a request is being processed, then increase the 'waiting' count,
         # so other threads may attempt to receive messages.
+        thread_id = thread.get_ident()
         self.__processing_condition.acquire()
         try:
             if not self.__open:
                 raise Exception, "Connection is closed"
 
-            handler = self.__response_handlers.get(thread.get_ident(), None)
+            handler = self.__response_handlers.get(thread_id, None)
             if handler is None:
-                handler = ResponseHandler(self.__processing_condition)
-                self.__response_handlers[handler.thread] = handler
+                # Reuse the handler from this thread's previous request, if
+                # any. It is held in thread-local storage, so it goes away
+                # with the thread.
+                handler = self.__thread_local.response_handler
+                if handler is None:
+                    handler = \
+                        ResponseHandler(self.__processing_condition, thread_id)
+                    self.__thread_local.response_handler = handler
+                self.__response_handlers[thread_id] = handler
 
             if self.__thread_request_count > 0:
                 self.__waiting += 1
-                if self.__processing == self.__waiting:
+                if self.__processing == self.__waiting and \
+                   self.__condition_waiters:
                     self.__processing_condition.notify()
         finally:
             self.__processing_condition.release()
@@ -330,7 +378,7 @@ Proxied Object Count: %r
         self.__processing_condition.acquire()
         try:
             self.__processing -= 1
-            if self.__processing == 0:
+            if self.__processing == 0 and self.__condition_waiters:
                 self.__processing_condition.notifyAll()
         finally:
             self.__processing_condition.release()
@@ -340,7 +388,8 @@ Proxied Object Count: %r
 
 
     def __waitForRequest(self):
-        pushy.util.logger.debug("Enter waitForRequest")
+        if _DEBUG:
+            pushy.util.logger.debug("Enter waitForRequest")
         # Wait for a request message. If a response message is received first,
         # then set the relevant response handler and wait until we're allowed
         # to read a message before proceeding.
@@ -353,10 +402,17 @@ Proxied Object Count: %r
                     self.__responses > 0 or \
                      (self.__processing > 0 and \
                       (self.__processing > self.__waiting))):
+                if _DEBUG:
+                    self.__log_state()
+                if self.__condition_waiters:
+                    self.__processing_condition.notify()
+                self.__condition_waiters += 1
+                try:
+                    self.__processing_condition.wait()
+                finally:
+                    self.__condition_waiters -= 1
+            if _DEBUG:
                 self.__log_state()
-                self.__processing_condition.notify()
-                self.__processing_condition.wait()
-            self.__log_state()
 
             # Check if the connection is still open.
             if not self.__open:
@@ -366,7 +422,8 @@ Proxied Object Count: %r
             if len(self.__requests) > 0:
                 request = self.__requests.pop()
                 self.__processing += 1
-                self.__processing_condition.notify()
+                if self.__condition_waiters:
+                    self.__processing_condition.notify()
                 return request
 
             # Release the processing condition, and wait for a message.
@@ -388,18 +445,24 @@ Proxied Object Count: %r
             finally:
                 self.__processing_condition.acquire()
                 self.__receiving = False
-                if notifyAll:
-                    self.__processing_condition.notifyAll()
-                else:
-                    self.__processing_condition.notify()
+                if self.__condition_waiters:
+                    if notifyAll:
+                        self.__processing_condition.notifyAll()
+                    else:
+                        self.__processing_condition.notify()
         finally:
             self.__processing_condition.release()
-            pushy.util.logger.debug("Leave waitForRequest")
+            if _DEBUG:
+                pushy.util.logger.debug("Leave waitForRequest")
 
 
     def __waitForResponse(self, handler):
-        pushy.util.logger.debug("Enter waitForResponse")
-        self.__processing_condition.acquire()
+        if _DEBUG:
+            pushy.util.logger.debug("Enter waitForResponse")
+        # The loop below re-evaluates connection state that other threads
+        # modify while we wait; only the condition itself can be held locally.
+        condition = self.__processing_condition
+        condition.acquire()
         try:
             # Wait until we're allowed to read from the input stream, or
             # another thread has enqueued a request for us.
@@ -407,25 +470,32 @@ Proxied Object Count: %r
                    (self.__receiving or \
                     (self.__processing > 0 and \
                      (self.__processing > self.__waiting))):
+                if _DEBUG:
+                    self.__log_state()
+                if self.__condition_waiters:
+                    condition.notify()
+                self.__condition_waiters += 1
+                try:
+                    condition.wait()
+                finally:
+                    self.__condition_waiters -= 1
+            if _DEBUG:
                 self.__log_state()
-                self.__processing_condition.notify()
-                self.__processing_condition.wait()
-            self.__log_state()
 
             # Wait until we've got a response message.
             if handler.message is None and self.__open:
                 self.__receiving = True
-                self.__processing_condition.release()
+                condition.release()
                 try:
                     m = self.__recv()
                     if m.target == 0:
-                        self.__requests.insert(0, m)
+                        self.__requests.appendleft(m)
                     else:
                         self.__response_handlers[m.target].message = m
                         if m.target != handler.thread:
                             self.__responses += 1
                 finally:
-                    self.__processing_condition.acquire()
+                    condition.acquire()
                     self.__receiving = False
             elif self.__open:
                 self.__responses -= 1
@@ -434,7 +504,7 @@ Proxied Object Count: %r
                 if handler.message.type not in response_types:
                     # Increment 'processing' count.
                     self.__processing += 1
-                elif self.__thread_request_count > 0:
+                elif self.__thread_local.request_count > 0:
                     # If we were waiting on a response, let the request
                     # handler thread know that we're once again processing our
                     # request.
@@ -445,35 +515,50 @@ Proxied Object Count: %r
             return handler.message
         finally:
             handler.message = None
-            self.__processing_condition.notifyAll()
-            self.__processing_condition.release()
-            pushy.util.logger.debug("Leave waitForResponse")
+            if self.__condition_waiters:
+                condition.notifyAll()
+            condition.release()
+            if _DEBUG:
+                pushy.util.logger.debug("Leave waitForResponse")
 
 
     def __marshal(self, obj):
         # XXX perhaps we can check refcount to optimise (if 1, immutable)
-        if type(obj) in marshallable_types:
+        type_ = type(obj)
+        if type_ in marshallable_types:
             return obj
 
-        # If it's a tuple, try to marshal each item individually.
-        if type(obj) is tuple:
-            return (MARSHAL_TUPLE, tuple(map(self.__marshal, obj)))
+        # If it's a tuple, try to marshal each item individually. Items of a
+        # marshallable type are passed through as-is, so only those items
+        # which need to be proxied incur a recursive call.
+        if type_ is tuple:
+            marshal_ = self.__marshal
+            items = []
+            append = items.append
+            for item in obj:
+                if type(item) in marshallable_types:
+                    append(item)
+                else:
+                    append(marshal_(item))
+            return (MARSHAL_TUPLE, tuple(items))
 
         i = id(obj)
         if i in self.__proxied_objects:
             # The object has previously been proxied.
             self.__marshal_lock.acquire()
             try:
-                if i in self.__proxied_objects:
-                    obj, result, version = self.__proxied_objects[i]
+                entry = self.__proxied_objects.get(i, None)
+                if entry is not None:
+                    obj, result, version = entry
                     self.__proxied_objects[i] = (obj, result, version+1)
                     return (MARSHAL_PROXY, result, version+1)
             finally:
                 self.__marshal_lock.release()
 
-        if i in self.__proxy_ids:
+        origin = self.__proxy_ids.get(i, None)
+        if origin is not None:
             # Object originates at the peer.
-            return (MARSHAL_ORIGIN, self.__proxy_ids[i][0])
+            return (MARSHAL_ORIGIN, origin[0])
         else:
             # Create new entry in proxy objects map:
             #    id -> (obj, opmask, proxy_type[, args])
@@ -483,8 +568,9 @@ Proxied Object Count: %r
             opmask = ProxyType.getoperators(obj)
             proxy_type = ProxyType.get(obj)
             args = ProxyType.getargs(proxy_type, obj)
-            pushy.util.logger.debug(
-                "Marshalling object: %r, %r", i, proxy_type)
+            if _DEBUG:
+                pushy.util.logger.debug(
+                    "Marshalling object: %r, %r", i, proxy_type)
 
             version = 0
             if args is not None:
@@ -499,7 +585,17 @@ Proxied Object Count: %r
     def __unmarshal(self, obj):
         if type(obj) is tuple:
             if obj[0] is MARSHAL_TUPLE:
-                return tuple(map(self.__unmarshal, obj[1]))
+                # Only tuple items carry marshalling information; anything
+                # else is a simple type, and is passed through as-is.
+                unmarshal_ = self.__unmarshal
+                items = []
+                append = items.append
+                for item in obj[1]:
+                    if type(item) is tuple:
+                        append(unmarshal_(item))
+                    else:
+                        append(item)
+                return tuple(items)
             elif obj[0] is MARSHAL_ORIGIN:
                 return self.__proxied_objects[obj[1]][0]
             elif obj[0] is MARSHAL_PROXY:
@@ -518,9 +614,10 @@ Proxied Object Count: %r
                 args = None
                 if len(description) > 3:
                     args = self.__unmarshal(description[3])
-                pushy.util.logger.debug(
-                    "Unmarshalling object: %r, %r, %r",
-                    oid, proxy_type, opmask)
+                if _DEBUG:
+                    pushy.util.logger.debug(
+                        "Unmarshalling object: %r, %r, %r",
+                        oid, proxy_type, opmask)
 
                 # New object: (id, opmask, object_type, args)
                 register_proxy = \
@@ -535,9 +632,10 @@ Proxied Object Count: %r
 
     def __register_proxy(self, proxy, remote_id, version):
         id_proxy = id(proxy)
-        pushy.util.logger.debug(
-            "Registering a proxy: %r -> id=%r, version=%r",
-            id_proxy, remote_id, version)
+        if _DEBUG:
+            pushy.util.logger.debug(
+                "Registering a proxy: %r -> id=%r, version=%r",
+                id_proxy, remote_id, version)
         if self.gc_enabled:
             ref = weakref.ref(proxy, lambda ref: self.delete(id_proxy))
         else:
@@ -547,24 +645,31 @@ Proxied Object Count: %r
 
 
     def __send_message(self, message_type, args):
-        # See if there are any objects to delete. If there are, send a delete
-        # message first.
-        self.__send_pending_deletes()
-
-        # Send the original message.
+        # Create the original message.
         thread_id = self.__peer_thread
         marshalled = self.__marshal(args)
         payload = marshal.dumps(marshalled, 1)
         m = Message(message_type, payload, thread_id)
-        pushy.util.logger.debug("Sending %r -> %r", m, thread_id)
-        self.__ostream.send_message(m)
+
+        # See if there are any objects to delete. If there are, a delete
+        # message is sent ahead of the original message, in the same write.
+        # This must come after marshalling, since taking the delete message
+        # clears the pending deletions; they would be lost if marshalling
+        # then failed.
+        delete_message = self.__get_delete_message()
+        if _DEBUG:
+            pushy.util.logger.debug("Sending %r -> %r", m, thread_id)
+        if delete_message is None:
+            self.__ostream.send_message(m)
+        else:
+            self.__ostream.send_messages((delete_message, m))
 
 
-    def __send_pending_deletes(self):
+    def __get_delete_message(self):
         """
         Checks if there are any pending deletions, and, if the garbage
-        collecton timer has expired, sends a deletion message and resets the
-        timer.
+        collecton timer has expired, returns a deletion message and resets the
+        timer. Otherwise, returns None.
 
         Note that this method does not check whether GC is enabled, since there
         may be deletions enqueued since before GC was disabled. The initial
@@ -573,7 +678,7 @@ Proxied Object Count: %r
         """
 
         if not self.__pending_deletes:
-            return
+            return None
 
         time_now = time.time()
         if time_now - self.__last_delete > self.gc_interval:
@@ -585,11 +690,14 @@ Proxied Object Count: %r
                     self.__last_delete = time.time()
                     try:
                         pending_items = tuple(pending.items())
-                        pushy.util.logger.debug("Deleting %r", pending_items)
+                        if _DEBUG:
+                            pushy.util.logger.debug(
+                                "Deleting %r", pending_items)
                         payload = marshal.dumps(pending_items, 1)
                         m = Message(MessageType.delete, payload, 0, 0)
-                        pushy.util.logger.debug("Sending %r", m)
-                        self.__ostream.send_message(m)
+                        if _DEBUG:
+                            pushy.util.logger.debug("Sending %r", m)
+                        return m
                     finally:
                         pending.clear()
             finally:
@@ -597,28 +705,34 @@ Proxied Object Count: %r
 
 
     def __recv(self):
-        pushy.util.logger.debug("Waiting for message")
+        if _DEBUG:
+            pushy.util.logger.debug("Waiting for message")
         m = self.__istream.receive_message()
         while m.type == MessageType.delete:
-            pushy.util.logger.debug("Received %r", m)
+            if _DEBUG:
+                pushy.util.logger.debug("Received %r", m)
             deleted_ids = marshal.loads(m.payload)
             self.__handle_delete(deleted_ids)
             m = self.__istream.receive_message()
-        pushy.util.logger.debug("Received %r", m)
+        if _DEBUG:
+            pushy.util.logger.debug("Received %r", m)
         return m
 
 
     def __handle(self, m):
-        pushy.util.logger.debug("[%r] Handling message: %r", self.__connid, m)
+        if _DEBUG:
+            pushy.util.logger.debug(
+                "[%r] Handling message: %r", self.__connid, m)
 
         # Track the number of requests being processed in this thread. May be
         # greater than one, if there is to-and-fro. We need to track this so
         # we know when to set the 'peer_thread'.
         is_request = m.type not in response_types
         if is_request:
-            self.__thread_request_count += 1
-            if self.__thread_request_count == 1:
-                self.__peer_thread = m.source
+            thread_local = self.__thread_local
+            thread_local.request_count += 1
+            if thread_local.request_count == 1:
+                thread_local.peer_thread = m.source
 
         try:
             try:
@@ -642,24 +756,26 @@ Proxied Object Count: %r
                 self.__processing_condition.acquire()
                 try:
                     self.__processing -= 1
-                    if self.__processing == 0:
+                    if self.__processing == 0 and self.__condition_waiters:
                         self.__processing_condition.notifyAll()
                 finally:
                     self.__processing_condition.release()
 
                 # Send the above three objects to the caller
-                import traceback
-                pushy.util.logger.debug(traceback.format_exc())
+                if _DEBUG:
+                    import traceback
+                    pushy.util.logger.debug(traceback.format_exc())
                 self.__send_message(MessageType.exception, e)
         finally:
             if is_request:
-                self.__thread_request_count -= 1
-                if self.__thread_request_count == 0:
-                    self.__peer_thread = 0
+                thread_local.request_count -= 1
+                if thread_local.request_count == 0:
+                    thread_local.peer_thread = 0
 
 
     def __handle_delete(self, deleted):
-        pushy.util.logger.debug("Handling delete: %r", deleted)
+        if _DEBUG:
+            pushy.util.logger.debug("Handling delete: %r", deleted)
         try:
             self.__marshal_lock.acquire()
             try:
@@ -671,8 +787,9 @@ Proxied Object Count: %r
             finally:
                 self.__marshal_lock.release()
         except:
-            import traceback
-            pushy.util.logger.debug(traceback.format_exc())
+            if _DEBUG:
+                import traceback
+                pushy.util.logger.debug(traceback.format_exc())
             raise
 
 
@@ -48,23 +48,38 @@ class MessageType(object):
 
 
 def read(file, length):
-    # Read message payload.
-    data = ""
-    if length:
-        while len(data) < length:
-            try:
-                partial = file.read(length - len(data))
-            except Exception, e:
-                raise IOError, e
-            if partial == "":
-                raise IOError, "End of file"
-            data += partial
-    return data
+    # Read message payload. Most streams return everything in one read, so
+    # that is tried first; otherwise, partial reads are collected and joined
+    # once, to avoid repeatedly copying the data read so far.
+    if not length:
+        return ""
+    try:
+        data = file.read(length)
+    except Exception, e:
+        raise IOError, e
+    if data == "":
+        raise IOError, "End of file"
+    if len(data) == length:
+        return data
+
+    parts = [data]
+    remaining = length - len(data)
+    while remaining > 0:
+        try:
+            partial = file.read(remaining)
+        except Exception, e:
+            raise IOError, e
+        if partial == "":
+            raise IOError, "End of file"
+        parts.append(partial)
+        remaining -= len(partial)
+    return "".join(parts)
 
 
 class Message:
     PACKING_FORMAT = ">BqqI"
-    PACKING_SIZE   = struct.calcsize(PACKING_FORMAT)
+    PACKING_STRUCT = struct.Struct(PACKING_FORMAT)
+    PACKING_SIZE   = PACKING_STRUCT.size
 
     def __init__(self, type, payload, target=0, source=None):
         self.type     = type
@@ -87,18 +102,16 @@ class Message:
                     len(self.payload))
 
     def pack(self):
-        return struct.pack(self.PACKING_FORMAT, int(self.type),
-                           self.source, self.target,
-                           len(self.payload)) + self.payload
+        return self.PACKING_STRUCT.pack(int(self.type), self.source,
+                                        self.target, len(self.payload)) + \
+                   self.payload
 
     @staticmethod
     def unpack(file):
         header = read(file, Message.PACKING_SIZE)
-        (type, source, target, length) = \
-            struct.unpack(Message.PACKING_FORMAT, header)
-        type = message_types[type]
+        (type, source, target, length) = Message.PACKING_STRUCT.unpack(header)
         payload = read(file, length)
-        return Message(type, payload, target, source)
+        return Message(message_types[type], payload, target, source)
 
 
 ###############################################################################
@@ -0,0 +1,57 @@
+# Copyright (c) 2011 Andrew Wilkins <axwalk@gmail.com>
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import gc, os, sys
+
+thisdir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(thisdir, ".."))
+
+import pushy, unittest
+
+class TestGC(unittest.TestCase):
+    def setUp(self):
+        self.conn = pushy.connect("local:")
+    def tearDown(self):
+        self.conn.close()
+
+    def __pending_deletes(self):
+        return self.conn.remote._BaseConnection__pending_deletes
+
+    def test_deletes_kept_on_marshal_error(self):
+        """
+        Ensure pending deletions are not lost if marshalling a request fails.
+        """
+        remote_len = self.conn.eval("len")
+        proxies = [self.conn.eval("object()") for i in range(3)]
+        del proxies
+        gc.collect()
+        pending = len(self.__pending_deletes())
+        self.assertTrue(pending >= 3)
+
+        # Slices pass through __marshal, but marshal.dumps rejects them.
+        self.conn.gc_interval = 0
+        self.assertRaises(ValueError, remote_len, (1, slice(1, 2)))
+        self.assertEqual(pending, len(self.__pending_deletes()))
+
+if __name__ == "__main__":
+    unittest.main()